@@ -13,5 +13,9 @@
 #  Copyright (c) 2020 remico
 
 from .spawned import *
+from .capture import *
 from .chroot import *
+from .console import *
+from .priority import *
+from .taskgraph import *
 from . import logger
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  This file is part of "Spawned" project
+#
+#  Author: Roman Gladyshev <remicollab@gmail.com>
+#  License: GNU Lesser General Public License v3.0 or later
+#
+#  SPDX-License-Identifier: LGPL-3.0+
+#  License text is available in the LICENSE file and online:
+#  http://www.gnu.org/licenses/lgpl-3.0-standalone.html
+#
+#  Copyright (c) 2020 remico
+
+"""Child output capture which spills to disk when the output grows too big"""
+
+import mmap
+import re
+
+from io import BytesIO
+from pathlib import Path
+
+from pexpect import EOF
+
+__all__ = ['Output']
+
+CHUNK_SIZE = 64 * 1024
+
+
+class Output:
+    """Read-only view of a child's output.
+
+    The content is kept as raw bytes, either in memory or in a memory-mapped file, and decoded lazily,
+    only for the requested part. Note: all offsets (slicing, :meth:`find`, :meth:`search`) are in bytes.
+    """
+
+    THRESHOLD = 16 * 1024 * 1024  # bytes to keep in memory before spilling to disk
+
+    def __init__(self, buffer=b'', file=None, encoding='utf-8'):
+        self._buf = buffer
+        self._file = file
+        self.encoding = encoding
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def __len__(self):
+        return len(self._buf)
+
+    def __bytes__(self):
+        return bytes(self._buf)
+
+    def __str__(self):
+        return self._decode(self._buf[:])
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self._decode(self._buf[key])
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("Output index out of range")
+        return self._decode(self._buf[key:key + 1])
+
+    def _decode(self, data):
+        return data.decode(self.encoding, errors='replace')
+
+    @property
+    def spilled(self):
+        """True if the output is stored on disk"""
+        return self._file is not None
+
+    def find(self, sub, start=0, end=None):
+        """Returns the lowest offset where ``sub`` is found; -1 otherwise"""
+        sub = sub.encode(self.encoding) if isinstance(sub, str) else sub
+        return self._buf.find(sub, start, len(self) if end is None else end)
+
+    def search(self, pattern, flags=0):
+        """Scans through the output looking for a regex ``pattern``. Returns a bytes :class:`re.Match` or None"""
+        pattern = pattern.encode(self.encoding) if isinstance(pattern, str) else pattern
+        return re.search(pattern, self._buf, flags)
+
+    def lines(self, start=0):
+        """Iterates over the output lines starting from the ``start`` offset; line endings are stripped"""
+        end = len(self)
+        while start < end:
+            eol = self._buf.find(b'\n', start)
+            stop = end if eol == -1 else eol
+            yield self._decode(self._buf[start:stop]).rstrip('\r')
+            start = stop + 1
+
+    def tail(self, n=10):
+        """Returns the last ``n`` lines of the output"""
+        end = len(self)
+        if end and self._buf[end - 1:end] == b'\n':
+            end -= 1  # ignore the trailing line ending
+        start = end
+        for _ in range(n):
+            start = self._buf.rfind(b'\n', 0, start)
+            if start == -1:
+                break
+        return list(self.lines(start + 1))[:n] if end else []
+
+    def close(self):
+        """Releases the storage. The view is empty afterwards."""
+        if isinstance(self._buf, mmap.mmap):
+            self._buf.close()
+        self._buf = b''
+        if self._file is not None:
+            Path(self._file).unlink(missing_ok=True)
+            self._file = None
+
+
+def capture(child, path, threshold=Output.THRESHOLD, encoding='utf-8'):
+    """Reads a pexpect ``child`` until EOF. At most ``threshold`` bytes are kept in memory,
+    the rest of the output goes to the ``path`` file.
+    """
+    mem, file = BytesIO(), None
+    sink = mem
+
+    # consume whatever was already read by the previous expect() calls
+    pending, child.buffer = child.buffer, child.string_type()
+    while True:
+        if pending:
+            sink.write(pending.encode(encoding) if isinstance(pending, str) else pending)
+            if file is None and mem.tell() > threshold:
+                file = Path(path).open('w+b')
+                file.write(mem.getbuffer())
+                mem, sink = None, file
+        try:
+            pending = child.read_nonblocking(CHUNK_SIZE, -1)
+        except EOF:
+            break
+
+    if file is None:
+        return Output(mem.getvalue(), encoding=encoding)
+
+    with file:
+        file.flush()
+        buf = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    return Output(buf, path, encoding)
@@ -14,8 +14,13 @@
 
 """Run bash commands in a chroot environment"""
 
+import threading
+
+from collections import Counter
 from pathlib import Path
+from time import time_ns
 
+from .exception import ChrootCommitError, ExitReason
 from .spawned import SpawnedSU, Spawned, _TMP, MODULE_PFX, onExit
 from . import logger as log
 
@@ -26,52 +31,185 @@ __all__ = ['Chroot', 'ChrootContext']
 def _p(*text): return text
 
 
+OVERLAY_PFX = "overlay_"
+SYSTEM_BINDS = ('/proc', '/sys', '/dev')
+
+_mountpoints = set()  # left in place by isolated chroots, since other namespaces may still use them
+_snapshots = Counter()  # number of active ephemeral chroots per base root
+_snapshots_lock = threading.Lock()
+
+
+def _succeeded(t):
+    return t is not None and t.exit_status == (0, ExitReason.NORMAL)
+
+
 class Chroot:
-    def __init__(self, root):
-        self.root = root
-        self.chroot_tmp = Path(root, str(_TMP)[1:])  # slice leading '/' to be able to concatenate
+    """Runs scripts inside the ``root`` tree.
+
+    If ``ephemeral`` is True, the scripts see a copy-on-write snapshot of ``root``: an overlayfs is mounted
+    with ``root`` as the read-only lower dir and a scratch upper dir under the temp-storage (or a tmpfs,
+    if ``tmpfs`` is True). All changes are discarded on teardown, unless ``commit`` is True - then they are
+    synced back into ``root`` with ``rsync``, provided the scripts have succeeded. Many snapshots can share
+    the same ``root`` simultaneously, but a commit is refused while other snapshots of the same ``root``
+    (made by this process) are active, since overlayfs doesn't allow changing the lower dir under a live mount.
+    A refused commit discards the changes and raises :class:`ChrootCommitError`.
+
+    If ``isolated`` is True, every script runs in a private mount namespace (``unshare -m``): all the mounts
+    the chroot needs are made there by the same privileged invocation which runs the script, and vanish
+    together with the namespace. The host mount table is never touched, except for the tmpfs of an ephemeral
+    chroot with ``tmpfs=True``: it must outlive the namespaces to keep the changes between scripts, so it's
+    mounted on the host, under the temp-storage, where the exit cleaner finds it.
+
+    ``binds`` is a list of host directories to bind into the chroot, e.g. :data:`SYSTEM_BINDS`. Allowed in
+    the isolated mode only, otherwise the mounts would leak into the host mount table if the process crashes.
+    """
+
+    def __init__(self, root, ephemeral=False, tmpfs=False, commit=False, isolated=False, binds=()):
+        self.base = root
+        self.ephemeral = ephemeral
+        self.tmpfs = tmpfs
+        self.commit = commit
+        self.isolated = isolated
+        self.binds = tuple(binds)
+        assert isolated or not self.binds, "Chroot: 'binds' require 'isolated=True'"
+        self.scratch = Path(_TMP, f"{OVERLAY_PFX}{time_ns()}") if ephemeral else None
+        self.root = self.scratch.joinpath('merged') if ephemeral else root
+
+    @property
+    def chroot_tmp(self):
+        return Path(self.root, str(_TMP)[1:])  # slice leading '/' to be able to concatenate
 
     def chroot_cmd(self, user=None):
         user_opt = f"--userspec={user}:{user}" if user else ""
-        return f'chroot {user_opt} {self.root} bash "{{}}"'
+        chroot = f'chroot {user_opt} {self.root} bash "{{}}"'
+        if not self.isolated:
+            return chroot
+        # everything dies with the namespace; the mountpoint dir is shared by all the concurrent namespaces
+        # in the same root though, so it's removed on exit only
+        if not self.ephemeral:
+            _mountpoints.add(self.chroot_tmp)
+        return self._isolate([*self._mounts(), chroot])
+
+    def snapshot(self, tmpfs=False, commit=False):
+        """Returns a copy-on-write context over the same root tree. Usage::
+
+            with Chroot(root).snapshot() as snap:
+                snap.do(script)
+                snap.commit = True  # optionally keep the changes
+        """
+        return ChrootContext(self.base, ephemeral=True, tmpfs=tmpfs, commit=commit,
+                             isolated=self.isolated, binds=self.binds)
+
+    @staticmethod
+    def _isolate(cmds, tail=""):
+        script = " && ".join(cmds) + (f"; {tail}" if tail else "")
+        return f"unshare -m bash -c '{script}'"
+
+    def _prepare_overlay(self):
+        s = self.scratch
+        cmds = [f"mkdir -p {s}"]
+        if self.tmpfs:
+            cmds.append(f"mount -t tmpfs tmpfs {s}")
+        cmds.append(f"mkdir -p {s}/upper {s}/work {self.root}")
+        return cmds
+
+    def _mount_overlay(self):
+        s = self.scratch
+        return [f"mount -t overlay overlay -o lowerdir={self.base},upperdir={s}/upper,workdir={s}/work {self.root}"]
+
+    def _mounts(self):
+        cmds = self._mount_overlay() if self.ephemeral else []
+        cmds.append(f"mkdir -p {self.chroot_tmp} && mount --bind {_TMP} {self.chroot_tmp}")
+        cmds += [f"mkdir -p {self.root}{b} && mount --rbind {b} {self.root}{b}" for b in self.binds]
+        return cmds
 
     def _before(self):
-        SpawnedSU.do(f"mkdir -p {self.chroot_tmp} && mount --bind {_TMP} {self.chroot_tmp}")
-
-    def _after(self):
-        SpawnedSU.do(f"umount {self.chroot_tmp} && rm -r {self.chroot_tmp}")
-
-    def do(self, script, user=None):
+        if self.ephemeral:
+            with _snapshots_lock:
+                _snapshots[str(self.base)] += 1
+        cmds = self._prepare_overlay() if self.ephemeral else []
+        if not self.isolated:
+            cmds += self._mounts()
+        if cmds:
+            SpawnedSU.do(" && ".join(cmds))
+
+    def _after(self, commit=False):
+        cmds = []
+        if not self.isolated:
+            cmds.append(f"umount {self.chroot_tmp} && rm -r {self.chroot_tmp}")
+        if not self.ephemeral:
+            if cmds:
+                SpawnedSU.do(" && ".join(cmds))
+            return
+
+        # hold the lock while committing, so no new snapshot of the base is mounted meanwhile
+        with _snapshots_lock:
+            refused = commit and _snapshots[str(self.base)] > 1
+            if commit and not refused:
+                # the _TMP mountpoint made by an isolated chroot stays in the upper dir, it mustn't get into base
+                rsync = f"rsync -aHAX --delete --exclude=/{str(_TMP)[1:]} {self.root}/ {self.base}/"
+                cmds.append(self._isolate([*self._mount_overlay(), rsync]) if self.isolated else rsync)
+            if not self.isolated:
+                cmds.append(f"umount {self.root}")
+            if self.tmpfs:
+                cmds.append(f"umount {self.scratch}")
+            cmds.append(f"rm -rf {self.scratch}")
+            try:
+                SpawnedSU.do(" && ".join(cmds))
+            finally:
+                _snapshots[str(self.base)] -= 1
+
+        if refused:
+            raise ChrootCommitError(f"Can't commit while other snapshots of {self.base} are active,"
+                                    f" the changes are discarded")
+
+    def do(self, script, user=None, **kwargs) -> Spawned:
+        """Set the chroot up, run script, wait until it ends and tear the chroot down.
+        An ephemeral chroot is committed only if the script has succeeded; raises :class:`ChrootCommitError`
+        if the commit is refused.
+        """
+        t = None
         try:
             self._before()
-            SpawnedSU.do_script(script, bg=False, cmd=self.chroot_cmd(user))
+            t = SpawnedSU.do_script(script, bg=False, cmd=self.chroot_cmd(user), **kwargs)
+            return t
         finally:
-            self._after()
+            self._after(commit=self.commit and _succeeded(t))
 
 
 class ChrootContext(Chroot):
     def __enter__(self):
+        self._children = []
         self._before()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self._after()
+        # never commit a failed snapshot: neither on exception, nor if any script has failed or is still running
+        self._after(commit=self.commit and exc_type is None and all(map(_succeeded, self._children)))
 
-    def do(self, script, user=None) -> Spawned:
+    def do(self, script, user=None, **kwargs) -> Spawned:
         """Run script and wait until it ends"""
-        return SpawnedSU.do_script(script, async_=False, bg=False, cmd=self.chroot_cmd(user))
+        t = SpawnedSU.do_script(script, async_=False, bg=False, cmd=self.chroot_cmd(user), **kwargs)
+        self._children.append(t)
+        return t
 
-    def doi(self, script, user=None) -> Spawned:
+    def doi(self, script, user=None, **kwargs) -> Spawned:
         """Run script and continue execution.
         Returned value can be used as context manager.
         """
-        return SpawnedSU.do_script(script, async_=True, bg=False, cmd=self.chroot_cmd(user))
+        t = SpawnedSU.do_script(script, async_=True, bg=False, cmd=self.chroot_cmd(user), **kwargs)
+        self._children.append(t)
+        return t
 
 
 def _cleaner(force=False):
     mp_tpl = MODULE_PFX if force else _TMP
-    if mounts := Spawned.do(f'mount | grep "{mp_tpl}" | cut -d" " -f3', list_=True):
+    # unmount in reverse order, so nested mounts (e.g. binds inside overlays) go first
+    if mounts := Spawned.do(f'mount | grep "{mp_tpl}" | cut -d" " -f3 | tac', list_=True):
         SpawnedSU.do(f'umount {" ".join(mounts)}')
+    if _mountpoints:
+        SpawnedSU.do(f'rmdir --ignore-fail-on-non-empty {" ".join(map(str, _mountpoints))}')
+        _mountpoints.clear()
 
 
 onExit(_cleaner)
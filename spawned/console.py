@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  This file is part of "Spawned" project
+#
+#  Author: Roman Gladyshev <remicollab@gmail.com>
+#  License: GNU Lesser General Public License v3.0 or later
+#
+#  SPDX-License-Identifier: LGPL-3.0+
+#  License text is available in the LICENSE file and online:
+#  http://www.gnu.org/licenses/lgpl-3.0-standalone.html
+#
+#  Copyright (c) 2020 remico
+
+"""Multiplexed console output of many concurrent children"""
+
+import sys
+import threading
+
+from atexit import register as onExit, unregister
+from itertools import count
+from queue import SimpleQueue, Empty
+from time import sleep
+from weakref import WeakSet
+
+from . import logger as log
+
+__all__ = ['Console']
+
+_PALETTE = [log._e(c) for c in (94, 92, 95, 93, 96, 91, 34, 32, 35, 33, 36, 31)]
+
+
+class _Channel:
+    """File-like log sink of a single child. Complete lines only are passed to the console."""
+
+    def __init__(self, console, tag):
+        self._console = console
+        self._tag = tag
+        self._partial = ''
+
+    def write(self, data):
+        *lines, self._partial = (self._partial + data).replace('\r\n', '\n').split('\n')
+        if lines:
+            self._console.put(''.join(f"{self._tag} {line}\n" for line in lines))
+
+    def flush(self):
+        pass  # the console flushes on its own schedule
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self._partial:
+            self._console.put(f"{self._tag} {self._partial}\n")
+            self._partial = ''
+
+
+class Console:
+    """Collects the output of all the children and prints it from a single renderer thread.
+
+    Every line is prefixed with a per-child tag, colored if ``file`` is a TTY. Lines are written
+    in batches, at most ``rate`` times per second, so the number of writes doesn't depend
+    on the number of children.
+    """
+
+    def __init__(self, file=sys.stdout, rate=20):
+        self._own_file = isinstance(file, str)
+        self.file = open(file, "w") if self._own_file else file
+        self.interval = 1 / rate
+        self.tty = getattr(self.file, 'isatty', lambda: False)()
+        self._queue = SimpleQueue()
+        self._ids = count(1)
+        self._channels = WeakSet()
+        self._thread = None
+        self._lock = threading.Lock()
+        onExit(self.close)
+
+    def channel(self, name) -> _Channel:
+        """Returns a log sink for a new child; ``name`` goes to the child's tag"""
+        n = next(self._ids)
+        tag = f"[{n}:{name}]"
+        if self.tty:
+            tag = _PALETTE[n % len(_PALETTE)] + tag + log._RESETALL
+        ch = _Channel(self, tag)
+        with self._lock:
+            self._channels.add(ch)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._render, name="spawned-console", daemon=True)
+                self._thread.start()
+        return ch
+
+    def put(self, text):
+        self._queue.put(text)
+
+    def _render(self):
+        while (item := self._queue.get()) is not None:  # sleep until there is something to print
+            sleep(self.interval)  # let the batch grow
+            chunks = [item]
+            try:
+                while (item := self._queue.get_nowait()) is not None:
+                    chunks.append(item)
+            except Empty:
+                pass
+            self.file.write(''.join(chunks))
+            self.file.flush()
+            if item is None:
+                break
+
+    def close(self):
+        """Prints all the pending output, including unfinished lines, stops the renderer
+        and closes the log file if it was opened by the console
+        """
+        with self._lock:
+            for ch in self._channels:
+                ch.close()
+            self._channels.clear()
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+                self._thread = None
+            if self._own_file and not self.file.closed:
+                self.file.close()
+        unregister(self.close)
@@ -16,7 +16,7 @@
 
 from dataclasses import dataclass
 
-__all__ = ['SpawnedChildError', 'ExitReason']
+__all__ = ['SpawnedChildError', 'ChrootCommitError', 'ExitReason']
 
 
 @dataclass(frozen=True)
@@ -35,3 +35,7 @@ class SpawnedChildError(Exception):
 
     def __str__(self):
         return f"{type(self).__name__}: <CODE: {self.code}>, REASON: {self.reason}"
+
+
+class ChrootCommitError(Exception):
+    """Raised when the changes of an ephemeral chroot can't be committed into its base root"""
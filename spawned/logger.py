@@ -36,19 +36,11 @@ _YELLOW = _e(93)
 _RED = _e(91)
 
 
+_ENDTAGS = {_BOLD: _ENDBOLD, _UNDERLINE: _ENDUNDERLINE, _BLINK: _ENDBLINK}
+
+
 def _wrap(tag, value):
-    if tag == _BOLD:
-        etag = _ENDBOLD
-    elif tag == _UNDERLINE:
-        etag = _ENDUNDERLINE
-    elif tag == _BLINK:
-        etag = _ENDBLINK
-    elif tag:
-        etag = _ENDCOLOR
-    else:
-        tag = ''
-        etag = ''
-    return tag + value + etag
+    return tag + value + _ENDTAGS.get(tag, _ENDCOLOR) if tag else value
 
 
 def _out(tag, *text, **kwargs):
@@ -67,9 +59,11 @@ def _str(f):
 
 
 def tagged(tag, formatter):
+    prefix = formatter(tag)  # the tag never changes, so format it once
+
     def f(func):
         def w(*args, **kwargs):
-            print(formatter(tag), *func(*args), **kwargs)
+            print(prefix, *func(*args), **kwargs)
         return w
     return f
 
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  This file is part of "Spawned" project
+#
+#  Author: Roman Gladyshev <remicollab@gmail.com>
+#  License: GNU Lesser General Public License v3.0 or later
+#
+#  SPDX-License-Identifier: LGPL-3.0+
+#  License text is available in the LICENSE file and online:
+#  http://www.gnu.org/licenses/lgpl-3.0-standalone.html
+#
+#  Copyright (c) 2020 remico
+
+"""CPU/IO scheduling priority of child processes"""
+
+from dataclasses import dataclass, field, replace
+from typing import Optional, Tuple, Union
+
+__all__ = ['Priority', 'PRIORITY_CLASSES']
+
+IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+
+@dataclass(frozen=True, order=True)
+class Priority:
+    """Scheduling settings applied to a child at spawn time.
+
+    :param rank: queuing order for executors, lower ranks are served first
+    :param nice: niceness, see ``nice(1)``; negative values need superuser privileges
+    :param ionice: IO scheduling class (a name from :data:`IONICE_CLASSES` or its number)
+        or a ``(class, level)`` tuple
+    :param cpus: CPU affinity, a CPU number, a list of them or a ``taskset(1)`` list string, e.g. ``"0-3,6"``
+    """
+    rank: int = 1
+    nice: Optional[int] = field(default=None, compare=False)
+    ionice: Union[str, int, Tuple[Union[str, int], int], None] = field(default=None, compare=False)
+    cpus: Union[str, int, Tuple[int, ...], None] = field(default=None, compare=False)
+
+    @staticmethod
+    def of(priority=None, **overrides):
+        """Resolves ``priority`` (a :data:`PRIORITY_CLASSES` name, a :class:`Priority` or None)
+        and applies non-None ``overrides`` on top of it
+        """
+        p = PRIORITY_CLASSES[priority] if isinstance(priority, str) else (priority or Priority())
+        overrides = {k: v for k, v in overrides.items() if v is not None}
+        return replace(p, **overrides) if overrides else p
+
+    @property
+    def prefix(self):
+        """Command line prefix which runs a command with these settings"""
+        cmd = []
+        if self.nice is not None:
+            cmd.append(f"nice -n {self.nice}")
+        if self.ionice is not None:
+            cls, level = self.ionice if isinstance(self.ionice, tuple) else (self.ionice, None)
+            cls = IONICE_CLASSES.get(cls, cls)
+            assert cls in IONICE_CLASSES.values(), f"Priority: unknown ionice class '{cls}'"
+            cmd.append(f"ionice -c {cls}" + (f" -n {level}" if level is not None else ""))
+        if self.cpus is not None:
+            cpus = self.cpus
+            if isinstance(cpus, int):
+                cpus = str(cpus)
+            elif not isinstance(cpus, str):
+                cpus = ",".join(map(str, cpus))
+            cmd.append(f"taskset -c {cpus}")
+        return " ".join(cmd + [""])
+
+
+PRIORITY_CLASSES = {
+    'interactive': Priority(0, ionice=('best-effort', 0)),
+    'normal': Priority(1),
+    'batch': Priority(2, nice=10, ionice=('best-effort', 7)),
+    'idle': Priority(3, nice=19, ionice='idle'),
+}
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  This file is part of "Spawned" project
+#
+#  Author: Roman Gladyshev <remicollab@gmail.com>
+#  License: GNU Lesser General Public License v3.0 or later
+#
+#  SPDX-License-Identifier: LGPL-3.0+
+#  License text is available in the LICENSE file and online:
+#  http://www.gnu.org/licenses/lgpl-3.0-standalone.html
+#
+#  Copyright (c) 2020 remico
+
+"""Records child sessions and replays them without running any real process"""
+
+import json
+
+from collections import deque
+from pathlib import Path
+from time import monotonic, sleep
+
+from pexpect import EOF, TIMEOUT
+from pexpect.spawnbase import SpawnBase
+
+__all__ = ['Recorder', 'ReplayChild']
+
+# event kinds
+OUT = "o"
+IN = "i"
+
+
+class _Channel:
+    """File-like sink for pexpect's ``logfile_read``/``logfile_send``"""
+
+    def __init__(self, recorder, kind):
+        self._recorder = recorder
+        self._kind = kind
+
+    def write(self, data):
+        self._recorder.add(self._kind, data)
+
+    def flush(self):
+        pass
+
+
+class Recorder:
+    """Captures the child's output chunks and the sent data with relative timestamps.
+
+    Recording format is a compact JSON document::
+
+        {"command": str, "exit": [exitstatus, signalstatus], "events": [[seconds, "o"|"i", data], ...]}
+    """
+
+    def __init__(self, path, command):
+        self.path = Path(path)
+        self.command = command
+        self.events = []
+        self._t0 = monotonic()
+
+    def attach(self, child):
+        child.logfile_read = _Channel(self, OUT)
+        child.logfile_send = _Channel(self, IN)
+        return self
+
+    def add(self, kind, data):
+        if data:
+            self.events.append([round(monotonic() - self._t0, 3), kind, data])
+
+    def dump(self, child):
+        """Saves the recording. Can be called repeatedly, the last call wins."""
+        record = {'command': self.command, 'exit': [child.exitstatus, child.signalstatus], 'events': self.events}
+        self.path.write_text(json.dumps(record, separators=(',', ':')))
+
+
+class ReplayChild(SpawnBase):
+    """A pexpect-compatible child which plays back a :class:`Recorder` file.
+
+    :param path: recording file
+    :param speed: 0 - replay as fast as possible; 1.0 - at recorded speed; 2.0 - twice as fast, etc.
+    """
+
+    def __init__(self, path, speed=0, timeout=30, logfile=None, encoding='utf-8', **kwargs):
+        # note: ``kwargs`` swallows pexpect.spawn() specific arguments, they make no sense here
+        super().__init__(timeout=timeout, logfile=logfile, encoding=encoding)
+        record = json.loads(Path(path).read_text())
+        self.command = record['command']
+        self.speed = speed
+        self.delayafterread = None  # there is no real pty to wait for
+        self.pid = None
+        self.closed = False
+        self.terminated = False
+        self.exitstatus = None
+        self.signalstatus = None
+        self._exit = record['exit']
+        self._events = deque(e for e in record['events'] if e[1] == OUT)  # sent data isn't needed to replay
+        self._t0 = monotonic()
+
+    def _finish(self):
+        self._events.clear()
+        if not self.terminated:
+            self.exitstatus, self.signalstatus = self._exit
+            self.terminated = True
+
+    def read_nonblocking(self, size=1, timeout=None):
+        if not self._events:
+            self._finish()
+            self.flag_eof = True
+            raise EOF('End Of File (EOF).')
+
+        if timeout == -1:
+            timeout = self.timeout
+
+        t, _, data = self._events[0]
+        if self.speed and (delay := self._t0 + t / self.speed - monotonic()) > 0:
+            if timeout is not None and delay > timeout:
+                sleep(timeout)
+                raise TIMEOUT('Timeout exceeded.')
+            sleep(delay)
+
+        self._events.popleft()
+        if len(data) > size:
+            self._events.appendleft([t, OUT, data[size:]])
+            data = data[:size]
+
+        self._log(data, 'read')
+        return data
+
+    def isalive(self):
+        if not self._events:
+            self._finish()
+        return not self.terminated
+
+    def send(self, s):
+        s = self._coerce_send_string(s)
+        self._log(s, 'send')
+        return len(s)
+
+    def sendline(self, s=''):
+        return self.send(s) + self.send(self.linesep)
+
+    def terminate(self, force=False):
+        self._finish()
+        return True
+
+    def close(self, force=True):
+        self._finish()
+        self.closed = True
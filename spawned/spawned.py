@@ -25,9 +25,14 @@ from functools import singledispatchmethod
 from os import getenv as ENV, getpid as PID, environ as _setenv
 from pathlib import Path
 from shutil import rmtree
+from threading import get_ident as TID
 from time import time_ns
 
+from .capture import Output, capture
+from .console import Console, _Channel
 from .exception import *
+from .priority import Priority
+from .replay import Recorder, ReplayChild
 from . import logger as log
 
 __all__ = ['Spawned', 'SpawnedSU', 'ask_user', 'onExit', 'ENV', 'SETENV', 'create_py_script']
@@ -36,6 +41,7 @@ __all__ = ['Spawned', 'SpawnedSU', 'ask_user', 'onExit', 'ENV', 'SETENV', 'creat
 UPASS = "UPASS"
 PIPE = "pipe"
 SCRIPT_PFX = "script_"
+OUTPUT_PFX = "output_"
 MODULE_PFX = "spawned_"
 TAG = "[Spawned]"
 TPL_REQ_UPASS = fr"password for {ENV('USER')}:"
@@ -117,16 +123,42 @@ class Spawned:
     _need_upass = _need_upass()
 
     def __init__(self, command, args=[], **kwargs):
+        """Extra keyword arguments (the rest is passed to ``pexpect.spawn()``):
+
+        :param sudo: run the command as superuser
+        :param user: run the command as ``user`` (with ``sudo`` only)
+        :param priority: a :class:`Priority` or a name from :data:`PRIORITY_CLASSES`
+        :param nice: niceness of the child, overrides the ``priority`` one; a negative value needs ``sudo=True``
+        :param ionice: IO scheduling class of the child, overrides the ``priority`` one
+        :param cpus: CPU affinity of the child, overrides the ``priority`` one
+        :param record: path to a file to record the session into, see :class:`Recorder`
+        :param replay: path to a recorded session to play back instead of running ``command``
+        :param replay_speed: 0 - replay as fast as possible; 1.0 - at recorded speed
+        """
         # note: pop extra arguments from kwargs before passing it to pexpect.spawn()
+        record = kwargs.pop('record', None)
+        replay = kwargs.pop('replay', None)
+        replay_speed = kwargs.pop('replay_speed', 0)
+        self._recorder = None
+
+        # apply scheduling settings to the command itself, so they're inherited by the whole process tree
+        prio = Priority.of(kwargs.pop('priority', None), nice=kwargs.pop('nice', None),
+                           ionice=kwargs.pop('ionice', None), cpus=kwargs.pop('cpus', None))
+
+        # detect sudo before the prefix hides a leading 'sudo' of the command
+        sudo = command.startswith("sudo")
         if kwargs.pop('sudo', False):
             user_opt = f'-u {user}' if (user := kwargs.pop('user', None)) else ''
-            command = f"sudo {user_opt} {command}"
+            command = f"sudo {user_opt} {prio.prefix}{command}"
+            sudo = True
+        else:
+            command = prio.prefix + command  # still inherited through a leading 'sudo' of the command
 
         # debugging output
         if Spawned._log_commands:
             self._print_command(command)
 
-        su = command.startswith("sudo") and Spawned._need_upass
+        su = sudo and Spawned._need_upass and not replay
         assert not su or ENV(UPASS), "User password isn't specified while 'sudo' is used. Exit..."
 
         timeout = kwargs.get('timeout', None)
@@ -135,11 +167,21 @@ class Spawned:
         else:
             assert timeout is None or timeout > 0, "'timeout' value (in sec) must be > 0"
 
-        self._child = pexpect.spawn(command, args, encoding='utf-8', logfile=self.log_file, echo=False, **kwargs)
+        if replay:
+            self._child = ReplayChild(replay, replay_speed, logfile=self.log_file, **kwargs)
+        else:
+            self._child = pexpect.spawn(command, args, encoding='utf-8', logfile=self.log_file, echo=False, **kwargs)
+
+        if isinstance(console := Spawned._log_file, Console):
+            self._child.logfile = console.channel(self._child.pid or 'replay')
 
         if su:
             self.interact(TPL_REQ_UPASS, ENV(UPASS))
 
+        # attach after the password is sent, so it never gets into the recording
+        if record:
+            self._recorder = Recorder(record, command).attach(self._child)
+
     def __enter__(self):
         return self
 
@@ -162,6 +204,7 @@ class Spawned:
                 return expect(pattern, timeout)
 
         except pexpect.EOF:
+            self._save_record()
             _pn(log.fail_s("Child unexpected EOF. Was expected one of: [%s]." % pattern))
             if ask_user("Abort application? [y/n]:").lower() == 'y':
                 sys.exit("\nABORTED BY USER")
@@ -172,6 +215,10 @@ class Spawned:
             if ask_user("Abort application? [y/n]:").lower() == 'y':
                 sys.exit("\nABORTED BY USER")
 
+        finally:
+            if pattern is Spawned.TASK_END:
+                self._save_record()
+
     def send(self, data):
         if self._child.isalive():
             self._child.sendline(data)
@@ -217,17 +264,19 @@ class Spawned:
         When the user types the 'escape character' (chr(29), i.e. ``Ctrl - ]``) this method returns None.
         The 'escape character' will not be transmitted.
         """
+        assert not isinstance(self._child, ReplayChild), "interact_user() isn't available for a replayed session"
 
         # prevent:
         # - data duplication in the user's terminal window
         # - app crash: since interact() method needs `bytes` buffer while spawn() method uses `unicode` by default
-        if self._child.logfile is sys.stdout:
+        logfile = self._child.logfile
+        if logfile is sys.stdout or isinstance(logfile, _Channel):
             self._child.logfile = None
 
         self._child.interact()
 
         # restore previous buffer after interactive input ends
-        self._child.logfile = self._log_file
+        self._child.logfile = logfile
 
     @staticmethod
     def _print_command(command):
@@ -240,7 +289,15 @@ class Spawned:
                 _p("@ PIPE:", pipe_path.read_text())
 
     @staticmethod
-    def do(command, with_status=False, list_=False, **kwargs):
+    def do(command, with_status=False, list_=False, spill=None, **kwargs):
+        """Runs ``command`` and returns its output.
+
+        :param with_status: return an :class:`ExitStatus` instead of just the output
+        :param list_: return the output as a list of lines
+        :param spill: return the output as an :class:`Output`, spilled to disk beyond ``spill`` bytes;
+            if True, :attr:`Output.THRESHOLD` is used. Can't be combined with ``list_``, use :meth:`Output.lines`
+        """
+        assert not (spill and list_), "'spill' and 'list_' are mutually exclusive"
         # to avoid bash failure, run as a script if there are special characters in the command
         chars = r"""~!@#$%^&*()+={}\[\]|\\:;"',><?\n"""
         is_special = re.search(f"[{chars}]", command)
@@ -251,17 +308,20 @@ class Spawned:
         else:
             t = Spawned(command, **kwargs)
 
+        def read():
+            if spill:
+                return t.capture(Output.THRESHOLD if spill is True else spill)
+            return t.datalines if list_ else t.data
+
         if with_status:
             # wait for the task ends by reading the output
-            data = t.datalines if list_ else t.data
+            data = read()
             # get exit status
-            t._child.isalive()  # update exit status from child's internals
-            reason = ExitReason.NORMAL if t._child.signalstatus is None else ExitReason.TERMINATED
-            code = t._child.exitstatus if reason == ExitReason.NORMAL else t._child.signalstatus
+            code, reason = t.exit_status
             success = reason == ExitReason.NORMAL and code == 0
             return ExitStatus(code, reason, success, data)
         else:
-            return t.datalines if list_ else t.data
+            return read()
 
     @staticmethod
     def do_script(script: str, async_=False, timeout=TIMEOUT_INFINITE, bg=True, **kwargs):
@@ -301,30 +361,62 @@ class Spawned:
     @staticmethod
     def tmp_file_path(new=True):
         _TMP.mkdir(exist_ok=True)
-        return _TMP.joinpath(f'{SCRIPT_PFX}{time_ns()}' if new else PIPE)
+        # the pipe file is unique per thread, so scripts can be run concurrently
+        return _TMP.joinpath(f'{SCRIPT_PFX}{time_ns()}' if new else f'{TID()}_{PIPE}')
 
     @staticmethod
     def enable_debug_commands(enable=True):
         Spawned._log_commands = enable
 
     @staticmethod
-    def enable_logging(file=sys.stdout):
-        """If ``file`` is a regular file, calling this method will truncate it"""
+    def enable_logging(file=sys.stdout, multiplex=False, rate=20):
+        """If ``file`` is a regular file, calling this method will truncate it.
+
+        If ``multiplex`` is True, the output of all the children goes through a single :class:`Console`,
+        line by line, prefixed with per-child tags, and is flushed at most ``rate`` times per second.
+        """
+        if isinstance(Spawned._log_file, Console):
+            Spawned._log_file.close()  # flush and release the replaced console
+        if multiplex:
+            Spawned._log_file = Console(file, rate)
+            return
         Spawned._log_file = file
         if isinstance(file, str):
             open(file, "w").close()  # truncate the log file
 
     @property
     def log_file(self):
-        return open(f, "a") if isinstance(f := Spawned._log_file, str) else f
+        if isinstance(f := Spawned._log_file, Console):
+            return None  # every child gets its own console channel after it's spawned
+        return open(f, "a") if isinstance(f, str) else f
+
+    def _save_record(self):
+        if self._recorder:
+            self._child.isalive()  # update exit status from child's internals
+            self._recorder.dump(self._child)
 
     @property
     def data(self):
-        return self._child.read().strip() if self._child.isalive() else ''
+        data = self._child.read().strip() if self._child.isalive() else ''
+        self._save_record()
+        return data
 
     @property
     def datalines(self):
-        return self._child.readlines() if self._child.isalive() else []
+        data = self._child.readlines() if self._child.isalive() else []
+        self._save_record()
+        return data
+
+    def capture(self, threshold=Output.THRESHOLD):
+        """Like :attr:`data`, but keeps at most ``threshold`` bytes of the output in memory.
+        The rest spills to a file in the temp-storage, which is memory-mapped for reading.
+        Unlike :attr:`data`, the output isn't stripped.
+        """
+        # no isalive() check here: a quick child may be gone already, while its output is still unread
+        _TMP.mkdir(exist_ok=True)
+        data = capture(self._child, _TMP.joinpath(f'{OUTPUT_PFX}{time_ns()}'), threshold)
+        self._save_record()
+        return data
 
     @property
     def exit_status(self):
@@ -335,6 +427,7 @@ class Spawned:
         self._child.isalive()  # update exit status from child's internals
         reason = ExitReason.NORMAL if self._child.signalstatus is None else ExitReason.TERMINATED
         code = self._child.exitstatus if reason == ExitReason.NORMAL else self._child.signalstatus
+        self._save_record()
         return code, reason
 
 
@@ -343,8 +436,8 @@ class SpawnedSU(Spawned):
         super().__init__(*args, sudo=True, **kwargs)
 
     @staticmethod
-    def do(command, with_status=False, list_=False, **kwargs):
-        return Spawned.do(command, with_status, list_, sudo=True, **kwargs)
+    def do(command, with_status=False, list_=False, spill=None, **kwargs):
+        return Spawned.do(command, with_status, list_, spill, sudo=True, **kwargs)
 
     @staticmethod
     def do_script(script: str, async_=False, timeout=Spawned.TIMEOUT_INFINITE, bg=True, **kwargs):
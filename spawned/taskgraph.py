@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  This file is part of "Spawned" project
+#
+#  Author: Roman Gladyshev <remicollab@gmail.com>
+#  License: GNU Lesser General Public License v3.0 or later
+#
+#  SPDX-License-Identifier: LGPL-3.0+
+#  License text is available in the LICENSE file and online:
+#  http://www.gnu.org/licenses/lgpl-3.0-standalone.html
+#
+#  Copyright (c) 2020 remico
+
+"""Run a graph of dependent shell steps in parallel"""
+
+import hashlib
+import json
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from pathlib import Path
+from time import monotonic
+from typing import Any, Optional, Tuple
+
+from .chroot import ChrootContext
+from .exception import ExitReason, SpawnedChildError
+from .priority import Priority
+from .spawned import Spawned, SpawnedSU
+from . import logger as log
+
+__all__ = ['Task', 'TaskGraph', 'TaskResult', 'TaskStatus']
+
+CHUNK_SIZE = 1024 * 1024
+
+
+@log.tagged("[TaskGraph]", log.ok_blue_s)
+def _p(*text): return text
+
+
+@dataclass(frozen=True)
+class TaskStatus:
+    DONE: str = "done"
+    CACHED: str = "cached"
+    FAILED: str = "failed"
+    BLOCKED: str = "blocked"
+
+
+@dataclass
+class Task:
+    """A step of a :class:`TaskGraph`.
+
+    :param deps: names of the tasks which must succeed before this one starts
+    :param inputs: files/dirs the result depends on; their content is a part of the task's fingerprint
+    :param chroot: a :class:`Chroot` (or an entered :class:`ChrootContext`) to run the script in
+    :param priority: a :class:`Priority` or a name from :data:`PRIORITY_CLASSES`; also defines
+        the order in which ready tasks are started
+    """
+    name: str
+    script: str
+    deps: Tuple[str, ...] = ()
+    inputs: Tuple[str, ...] = ()
+    chroot: Any = None
+    user: Optional[str] = None
+    sudo: bool = False
+    priority: Any = None
+
+
+@dataclass
+class TaskResult:
+    name: str
+    status: str
+    duration: float = 0.0
+    exit_code: Optional[int] = None
+    exit_reason: Optional[int] = None
+    fingerprint: Optional[str] = field(default=None, repr=False)
+
+    @property
+    def success(self):
+        return self.status in (TaskStatus.DONE, TaskStatus.CACHED)
+
+
+class TaskGraph:
+    """Runs tasks in dependency order, independent tasks in parallel (at most ``jobs`` at once).
+
+    If ``cache`` file is given, fingerprints of succeeded tasks are stored there, and a task is skipped
+    when its fingerprint (script, user, chroot, inputs content and fingerprints of the dependencies)
+    matches the stored one. Usage::
+
+        g = TaskGraph(jobs=4, cache="build.cache")
+        g.add("debootstrap", "debootstrap focal /mnt/root", sudo=True)
+        g.add("locale", "locale-gen en_US.UTF-8", deps=["debootstrap"], chroot=Chroot("/mnt/root"))
+        g.report(g.run())
+    """
+
+    def __init__(self, jobs=os.cpu_count(), cache=None):
+        self.jobs = jobs or 1
+        self.cache = Path(cache) if cache else None
+        self.tasks = {}
+        self._locks = {}
+
+    def add(self, name, script, deps=(), inputs=(), **kwargs) -> Task:
+        assert name not in self.tasks, f"TaskGraph: task '{name}' already exists"
+        assert not kwargs.get('user') or kwargs.get('sudo') or kwargs.get('chroot') is not None, \
+            f"TaskGraph: task '{name}': 'user' requires 'sudo=True' or 'chroot'"
+        task = Task(name, script, tuple(deps), tuple(inputs), **kwargs)
+        self.tasks[name] = task
+        return task
+
+    def _order(self):
+        """Returns task names in a topological order"""
+        order, state = [], {}  # state: 1 - visiting, 2 - done
+
+        def visit(name, path):
+            if (s := state.get(name)) == 2:
+                return
+            if s == 1:
+                raise ValueError(f"TaskGraph: dependency cycle: {' -> '.join(path + [name])}")
+            if name not in self.tasks:
+                raise ValueError(f"TaskGraph: unknown task '{name}' required by '{path[-1]}'")
+            state[name] = 1
+            for dep in self.tasks[name].deps:
+                visit(dep, path + [name])
+            state[name] = 2
+            order.append(name)
+
+        for name in self.tasks:
+            visit(name, [])
+        return order
+
+    @staticmethod
+    def _hash_input(h, path):
+        path = Path(path)
+        files = sorted(p for p in path.rglob('*') if p.is_file()) if path.is_dir() else [path]
+        for f in files:
+            h.update(str(f).encode())
+            if not f.is_file():
+                h.update(b'<missing>')
+                continue
+            with f.open('rb') as fh:
+                for chunk in iter(lambda: fh.read(CHUNK_SIZE), b''):
+                    h.update(chunk)
+
+    def fingerprint(self, task, deps_fp):
+        h = hashlib.sha256()
+        chroot = getattr(task.chroot, 'base', None)
+        h.update(json.dumps([task.script, task.user, task.sudo, str(chroot)]).encode())
+        for path in task.inputs:
+            self._hash_input(h, path)
+        for dep in sorted(task.deps):
+            h.update(deps_fp[dep].encode())
+        return h.hexdigest()
+
+    def _chroot_lock(self, chroot):
+        # a plain Chroot mounts/unmounts around every script, so parallel scripts in the same root would clash;
+        # an entered context has nothing to set up, and isolated runs only share the _TMP mountpoint dir,
+        # which is kept in place until exit (removing it would detach the bind in all the other namespaces)
+        if isinstance(chroot, ChrootContext) or (chroot.isolated and not chroot.ephemeral):
+            return nullcontext()
+        # snapshots can't be committed while other snapshots of the same base are active
+        key = chroot.base if chroot.ephemeral and chroot.commit else chroot.root
+        return self._locks.setdefault(str(key), threading.Lock())
+
+    def _execute(self, task):
+        kwargs = {'priority': task.priority} if task.priority else {}
+        t0 = monotonic()
+        try:
+            if task.chroot is not None:
+                with self._chroot_lock(task.chroot):
+                    t = task.chroot.do(task.script, task.user, **kwargs)
+            else:
+                runner = SpawnedSU if task.sudo else Spawned
+                if task.user:
+                    kwargs['user'] = task.user
+                t = runner.do_script(task.script, bg=False, **kwargs)
+        except Exception as e:
+            # one broken step mustn't lose the results of the whole run
+            _p(log.fail_s(f"{task.name}: {type(e).__name__}: {e}"))
+            return TaskResult(task.name, TaskStatus.FAILED, monotonic() - t0)
+        code, reason = t.exit_status
+        success = reason == ExitReason.NORMAL and code == 0
+        status = TaskStatus.DONE if success else TaskStatus.FAILED
+        return TaskResult(task.name, status, monotonic() - t0, code, reason)
+
+    def run(self, check=False):
+        """Runs all the tasks. Returns a dict of :class:`TaskResult` by task names, in the topological order.
+
+        :param check: if True, raise :class:`SpawnedChildError` if any task has failed; the results
+            are available as its ``results`` attribute then
+        """
+        order = self._order()
+        rank = {name: (Priority.of(self.tasks[name].priority).rank, i) for i, name in enumerate(order)}
+        cache = json.loads(self.cache.read_text()) if self.cache and self.cache.exists() else {}
+        waiting = {name: set(self.tasks[name].deps) for name in order}
+        results, fps = {}, {}
+
+        def finish(result):
+            results[result.name] = result
+            if result.success:
+                for deps in waiting.values():
+                    deps.discard(result.name)
+            else:
+                # nothing depending on a failed task can run
+                for name in [n for n in order if n in waiting and result.name in self.tasks[n].deps]:
+                    if waiting.pop(name, None) is not None:  # may be already blocked via another dependency
+                        finish(TaskResult(name, TaskStatus.BLOCKED))
+
+        try:
+            with ThreadPoolExecutor(self.jobs) as pool:
+                running = {}
+                while waiting or running:
+                    ready = sorted((n for n, deps in waiting.items() if not deps), key=rank.get)
+                    for name in ready[:max(self.jobs - len(running), 0)]:
+                        del waiting[name]
+                        task = self.tasks[name]
+                        fps[name] = self.fingerprint(task, fps)
+                        if cache.get(name) == fps[name]:
+                            finish(TaskResult(name, TaskStatus.CACHED, fingerprint=fps[name]))
+                        else:
+                            running[pool.submit(self._execute, task)] = name
+                    if not running:
+                        continue  # cached tasks may have released others
+
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        name = running.pop(future)
+                        result = future.result()
+                        result.fingerprint = fps[name]
+                        if result.success:
+                            cache[name] = fps[name]
+                        else:
+                            cache.pop(name, None)
+                        finish(result)
+        finally:
+            if self.cache:
+                self.cache.write_text(json.dumps(cache, indent=2))
+
+        results = {name: results[name] for name in order}
+        if check and (failed := next((r for r in results.values() if r.status == TaskStatus.FAILED), None)):
+            err = SpawnedChildError(failed.exit_code, failed.exit_reason)
+            err.results = results
+            raise err
+        return results
+
+    @staticmethod
+    def report(results):
+        """Prints per-task statuses and timings"""
+        for r in results.values():
+            status = log.ok_green_s(f"{r.status:<8}") if r.success else log.fail_s(f"{r.status:<8}")
+            _p(f"{r.name:<24}", status, f"{r.duration:8.2f}s")
+        _p(f"{'TOTAL (sum)':<24}", " " * 8, f"{sum(r.duration for r in results.values()):8.2f}s")